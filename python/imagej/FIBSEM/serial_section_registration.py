@@ -25,21 +25,24 @@ from mpicbg.imagefeatures import FloatArray2DSIFT
 from mpicbg.ij.util import Filter, Util
 from mpicbg.ij import SIFT
 from mpicbg.ij.plugin import NormalizeLocalContrast
-from java.util import ArrayList
+from java.util import ArrayList, List
 from java.lang import Double
+from java.io import RandomAccessFile, FileOutputStream
+from java.nio import ByteBuffer
+from java.nio.channels import FileChannel
 from lib.io import readUnsignedShorts, read2DImageROI, ImageJLoader, lazyCachedCellImg, SectionCellLoader
-from lib.util import SoftMemoize, newFixedThreadPool, Task, ParallelTasks, numCPUs, nativeArray, syncPrint
+from lib.util import SoftMemoize, newFixedThreadPool, Task, ParallelTasks, numCPUs, nativeArray, syncPrint, Getter
 from lib.features import savePointMatches, loadPointMatches
 from lib.registration import loadMatrices, saveMatrices
 from lib.ui import showStack, wrap
 from net.imglib2.type.numeric.integer import UnsignedShortType
 from net.imglib2.view import Views
-from ij.process import FloatProcessor
+from ij.process import FloatProcessor, ShortProcessor
 from ij import IJ, ImageListener, ImagePlus
 from net.imglib2.img.io.proxyaccess import ShortAccessProxy
 from net.imglib2.img.cell import LazyCellImg, Cell, CellGrid
 from net.imglib2.img.display.imagej import ImageJFunctions as IL
-from net.imglib2.img.array import ArrayImgs
+from net.imglib2.img.array import ArrayImgs, ArrayImg
 from net.imglib2.img import ImgView
 from net.imglib2.util import ImgUtil, Intervals
 from net.imglib2.realtransform import RealViews, AffineTransform2D
@@ -49,6 +52,7 @@ from net.imglib2.type.PrimitiveType import BYTE
 from java.awt.event import KeyAdapter, KeyEvent
 from jarray import zeros, array
 from functools import partial
+from fiji.scripting import Weaver
 
 srcDir = "/groups/cardona/cardonalab/FIBSEM_L1116/" # MUST have an ending slash
 tgtDir = "/groups/cardona/cardonalab/Albert/FIBSEM_L1116/"
@@ -94,6 +98,11 @@ paramsSIFT.steps = 3
 paramsSIFT.minOctaveSize = int(paramsSIFT.maxOctaveSize / pow(2, paramsSIFT.steps))
 paramsSIFT.initialSigma = 1.6 # default 1.6
 
+# Points of the mesh for blockmatching: the same for every pair, given that all images have the same dimensions
+meshSourcePoints = ArrayList()
+PointMatch.sourcePoints(TransformMesh(params["meshResolution"], dimensions[0], dimensions[1]).getVA().keySet(),
+                        meshSourcePoints)
+
 
 # Ensure target directories exist
 if not os.path.exists(tgtDir):
@@ -104,6 +113,11 @@ csvDir = os.path.join(tgtDir, "csvs")
 if not os.path.exists(csvDir):
   os.mkdir(csvDir)
 
+prescaledDir = os.path.join(csvDir, "prescaled")
+
+if not os.path.exists(prescaledDir):
+  os.mkdir(prescaledDir)
+
 def loadImp(filepath):
   # Images are TIFF with bit pack compression: can't byte-read array
   syncPrint("Loading image " + filepath)
@@ -113,19 +127,147 @@ def loadUnsignedShort(filepath):
     imp = loadImp(filepath)
     return ArrayImgs.unsignedShorts(imp.getProcessor().getPixels(), [imp.getWidth(), imp.getHeight()])
 
+def downsample2x(fp):
+  """ Blur the FloatProcessor in place with the separable 5-tap binomial kernel [1, 4, 6, 4, 1]/16,
+      whose sigma is 1 pixel, and then return a new FloatProcessor with every other pixel. """
+  kernel = array([1, 4, 6, 4, 1], 'f') # normalized by convolve
+  fp.convolve(kernel, 5, 1)
+  fp.convolve(kernel, 1, 5)
+  fp.setInterpolationMethod(FloatProcessor.NONE)
+  return fp.resize(fp.getWidth() / 2, fp.getHeight() / 2)
+
+
+def downscaleStaged(fp, targetScale, sourceSigma, targetSigma):
+  """ Scale down in stages of 2x with downsample2x until within 2x of the targetScale,
+      then scale down the remainder with a Gaussian blur at the small size,
+      so that the result has the targetSigma like with Filter.createDownsampled.
+      Much cheaper than a Gaussian with a large sigma at the original resolution. """
+  width = fp.getWidth()
+  sigma = sourceSigma
+  # Halve only while the target width is below the halved width (rounded down, like downsample2x does),
+  # so that the scale still to apply remains below 1: createDownsampled must never upsample
+  while targetScale * width < fp.getWidth() / 2:
+    fp = downsample2x(fp)
+    sigma = pow(sigma * sigma + 1, 0.5) / 2 # in pixels of the downsampled image
+  return Filter.createDownsampled(fp, targetScale * width / float(fp.getWidth()), sigma, targetSigma)
+
+
 def loadFloatProcessor(filepath, scale=True):
   try:
     fp = loadImp(filepath).getProcessor().convertToFloatProcessor()
     # Preprocess images: Gaussian-blur to scale down, then normalize contrast
     if scale:
-      fp = Filter.createDownsampled(fp, params["scale"], 0.5, 1.6)
+      fp = downscaleStaged(fp, params["scale"], 0.5, 1.6)
       Util.normalizeContrast(fp)
     return fp
   except:
     syncPrint(sys.exc_info())
 
+# Increment when changing the preprocessing in loadFloatProcessor,
+# so that files stored by loadFPCached with the prior preprocessing are not reused
+PREPROCESSING_VERSION = 2
+
+def dequantize(width, height, shorts, minimum, maximum):
+  """ Return a FloatProcessor with the 16-bit pixels mapped back to the range between minimum and maximum. """
+  fp = ShortProcessor(width, height, shorts, None).convertToFloatProcessor()
+  fp.multiply((maximum - minimum) / 65535.0)
+  fp.add(minimum)
+  fp.resetMinAndMax()
+  return fp
+
+def loadFPCached(filepath):
+  """ Load the scaled and contrast-normalized FloatProcessor from a file in prescaledDir,
+      or, when not there yet, create it with loadFloatProcessor and store it for future runs.
+      The file has a 16-byte header (width, height as int; min, max as float)
+      followed by the pixels quantized to 16-bit between min and max.
+      Either way, returns the dequantized image, so that results don't depend on whether the file existed. """
+  path = os.path.join(prescaledDir, "%s.scale%s.v%i.u16" % (basename(filepath), str(params["scale"]), PREPROCESSING_VERSION))
+  if os.path.exists(path):
+    ra = RandomAccessFile(path, 'r')
+    try:
+      bb = ra.getChannel().map(FileChannel.MapMode.READ_ONLY, 0, ra.length())
+      width, height = bb.getInt(), bb.getInt()
+      minimum, maximum = bb.getFloat(), bb.getFloat()
+      shorts = zeros(width * height, 'h')
+      bb.asShortBuffer().get(shorts)
+      return dequantize(width, height, shorts, minimum, maximum)
+    finally:
+      ra.close()
+  # Else, create it and store it
+  fp = loadFloatProcessor(filepath, scale=True)
+  if fp is None:
+    return None
+  fp.resetMinAndMax()
+  minimum, maximum = fp.getMin(), fp.getMax()
+  fq = fp.duplicate()
+  fq.subtract(minimum)
+  fq.multiply(65535.0 / max(maximum - minimum, 0.000001))
+  shorts = fq.convertToShortProcessor(False).getPixels() # clamps and rounds
+  bb = ByteBuffer.allocate(16 + len(shorts) * 2)
+  bb.putInt(fp.getWidth()).putInt(fp.getHeight()).putFloat(minimum).putFloat(maximum)
+  bb.asShortBuffer().put(shorts)
+  bb.rewind()
+  # Write to a temporary file first, so that an interrupted write can't leave behind a partial file
+  tmppath = path + ".tmp"
+  fos = FileOutputStream(tmppath)
+  try:
+    channel = fos.getChannel()
+    while bb.hasRemaining():
+      channel.write(bb)
+    channel.force(False)
+  finally:
+    fos.close()
+  os.rename(tmppath, path)
+  # Read min, max back from the header: stored as float, with less precision
+  return dequantize(fp.getWidth(), fp.getHeight(), shorts, bb.getFloat(8), bb.getFloat(12))
+
 loadImpMem = SoftMemoize(loadImp, maxsize=128)
-loadFPMem = SoftMemoize(loadFloatProcessor, maxsize=64)
+loadFPMem = SoftMemoize(loadFPCached, maxsize=64)
+
+
+def computeSIFTFeatures(filepath):
+  """ Extract SIFT features from the full-resolution image.
+      Returns an ArrayList of Feature instances, not to be modified afterwards
+      given that it is shared among all pairs that include this section. """
+  features = ArrayList() # of Feature instances
+  ijSIFT = SIFT(FloatArray2DSIFT(paramsSIFT))
+  ijSIFT.extractFeatures(loadFloatProcessor(filepath, scale=False), features)
+  return features
+
+# Each section can be paired with up to 2 * n_adjacent others: extract its SIFT features only once
+siftFeaturesMem = SoftMemoize(computeSIFTFeatures, maxsize=64)
+
+
+def submitLoad(load, filepath, exe):
+  """ Return a Future with the image for filepath, loaded in the ExecutorService exe.
+      Load functions with a submit method, like SoftMemoize, return the image right away
+      when in memory, or the Future of a load in progress for the same filepath. """
+  if hasattr(load, "submit"):
+    return load.submit(filepath, exe)
+  return exe.submit(Task(load, filepath))
+
+
+class SectionLoader:
+  """ Wraps a load function, holding onto the image of one section once loaded,
+      so that it remains in memory while all pairs that include the section are processed. """
+  def __init__(self, load, filepath):
+    self.load = load
+    self.filepath = filepath
+    self.fp = None
+
+  def submit(self, filepath, exe):
+    if filepath != self.filepath:
+      return submitLoad(self.load, filepath, exe)
+    if self.fp is not None:
+      return Getter(self.fp)
+    return exe.submit(Task(self, filepath))
+
+  def __call__(self, filepath):
+    if filepath != self.filepath:
+      return self.load(filepath)
+    if self.fp is None:
+      self.fp = self.load(filepath)
+    return self.fp
 
 
 def extractBlockMatches(filepath1, filepath2, params, csvDir, exeload, load=loadFPMem):
@@ -146,14 +288,12 @@ def extractBlockMatches(filepath1, filepath2, params, csvDir, exeload, load=load
 
   try:
 
-    # Load files in parallel
-    futures = [exeload.submit(Task(load, filepath1)),
-               exeload.submit(Task(load, filepath2))]
+    # Load files in parallel, unless already in memory or being loaded
+    futures = [submitLoad(load, filepath, exeload) for filepath in (filepath1, filepath2)]
   
     # Define points from the mesh
-    sourcePoints = ArrayList()
-    mesh = TransformMesh(params["meshResolution"], dimensions[0], dimensions[1])
-    PointMatch.sourcePoints( mesh.getVA().keySet(), sourcePoints )
+    # (A shallow copy: BlockMatching doesn't modify the Point instances)
+    sourcePoints = ArrayList(meshSourcePoints)
     # List to fill
     sourceMatches = ArrayList() # of PointMatch from filepath1 to filepath2
 
@@ -180,14 +320,11 @@ def extractBlockMatches(filepath1, filepath2, params, csvDir, exeload, load=load
       # Can fail if there is a shift larger than the searchRadius
       # Try SIFT features, which are location independent
       #
-      # Images are now scaled: load originals
-      futures = [exeload.submit(Task(loadFloatProcessor, filepath1, scale=False)),
-                 exeload.submit(Task(loadFloatProcessor, filepath2, scale=False))]
-      ijSIFT = SIFT(FloatArray2DSIFT(paramsSIFT))
-      features1 = ArrayList() # of Point instances
-      ijSIFT.extractFeatures(futures[0].get(), features1)
-      features2 = ArrayList() # of Point instances
-      ijSIFT.extractFeatures(futures[1].get(), features2)
+      # Images are now scaled: extract features from the originals, in parallel
+      futures = [siftFeaturesMem.submit(filepath1, exeload),
+                 siftFeaturesMem.submit(filepath2, exeload)]
+      features1 = futures[0].get() # ArrayList of Feature instances
+      features2 = futures[1].get()
       # Vector of PointMatch instances
       sourceMatches = FloatArray2DSIFT.createMatches(features1,
                                                      features2,
@@ -209,22 +346,44 @@ def extractBlockMatches(filepath1, filepath2, params, csvDir, exeload, load=load
     syncPrint("".join(traceback.format_exception()), out="stderr")
 
 
-def pointmatchingTasks(filepaths, csvDir, params, n_adjacent, exeload):
+def extractBlockMatchesForSection(filepaths, i, n_adjacent, params, csvDir, exeload, load=loadFPMem):
+  """
+  Extract block matches between the section at index i and each of its n_adjacent following sections,
+  holding onto the image of section i so that it is loaded only once for all its pairs.
+
+  return the number of pairs whose pointmatches had to be computed.
+  """
+  loadSection = SectionLoader(load, filepaths[i])
+  count = 0
+  for inc in xrange(1, n_adjacent + 1):
+    if extractBlockMatches(filepaths[i], filepaths[i + inc], params, csvDir, exeload, load=loadSection):
+      count += 1
+  return count
+
+
+def pointmatchingTasks(filepaths, csvDir, params, n_adjacent, exeload, existing=frozenset()):
+  """ existing: the set of file names already present in csvDir,
+      to skip sections whose pointmatches CSV files all exist without a stat call per file. """
   for i in xrange(len(filepaths) - n_adjacent):
-    for inc in xrange(1, n_adjacent + 1):
-      #syncPrint("Preparing extractBlockMatches for: \n  1: %s\n  2: %s" % (filepaths[i], filepaths[i+inc]))
-      yield Task(extractBlockMatches, filepaths[i], filepaths[i + inc], params, csvDir, exeload)
+    csvnames = (basename(filepaths[i]) + '.' + basename(filepaths[i + inc]) + ".pointmatches.csv"
+                for inc in xrange(1, n_adjacent + 1))
+    if all(csvname in existing for csvname in csvnames):
+      continue
+    yield Task(extractBlockMatchesForSection, filepaths, i, n_adjacent, params, csvDir, exeload)
 
 
 def ensurePointMatches(filepaths, csvDir, params, n_adjacent):
   """ If a pointmatches csv file doesn't exist, will create it. """
   w = ParallelTasks("ensurePointMatches", exe=newFixedThreadPool(numCPUs()))
   exeload = newFixedThreadPool()
+  # A single directory listing instead of one file existence check per pair,
+  # which is slow in a network file system when most CSV files exist already
+  existing = set(os.listdir(csvDir))
   try:
     count = 1
-    for result in w.chunkConsume(numCPUs() * 2, pointmatchingTasks(filepaths, csvDir, params, n_adjacent, exeload)):
-      if result: # is False when CSV file already exists
-        syncPrint("Completed %i/%i" % (count, len(filepaths) * n_adjacent))
+    for result in w.streamConsume(numCPUs() * 4, pointmatchingTasks(filepaths, csvDir, params, n_adjacent, exeload, existing=existing)):
+      if result: # is zero when all CSV files of the section already exist
+        syncPrint("Completed section %i/%i" % (count, len(filepaths) - n_adjacent))
       count += 1
     syncPrint("Awaiting all remaining pointmatching tasks to finish.")
     w.awaitAll()
@@ -248,6 +407,17 @@ def loadPointMatchesTasks(filepaths, csvDir, params, n_adjacent):
     for inc in xrange(1, n_adjacent + 1):
       yield Task(loadPointMatchesPlus, filepaths, i, i + inc, csvDir, params)
 
+# Connect all pairs of tiles in a single call, rather than one jython-to-java call per pair
+tileLinker = Weaver.method("""
+  static public final void connectAll(final Tile[] tiles, final int[] is, final int[] js, final List pointmatches) {
+    for (int k=0; k<is.length; ++k) {
+      final List pms = (List) pointmatches.get(k);
+      if (null == pms) continue; // missing pointmatches
+      tiles[is[k]].connect(tiles[js[k]], pms); // reciprocal connection
+    }
+  }
+""", [Tile, List])
+
 # When done, optimize tile pose globally
 def makeLinkedTiles(filepaths, csvDir, params, n_adjacent):
   ensurePointMatches(filepaths, csvDir, params, n_adjacent)
@@ -257,10 +427,14 @@ def makeLinkedTiles(filepaths, csvDir, params, n_adjacent):
     #w = ParallelTasks("loadPointMatches")
     #for i, j, pointmatches in w.chunkConsume(numCPUs() * 2, loadPointMatchesTasks(filepaths, csvDir, params, n_adjacent)):
     syncPrint("Loading all pointmatches.")
+    indices1, indices2, pointmatches_list = [], [], ArrayList()
     for task in loadPointMatchesTasks(filepaths, csvDir, params, n_adjacent):
       i, j, pointmatches = task.call()
-      tiles[i].connect(tiles[j], pointmatches) # reciprocal connection
+      indices1.append(i)
+      indices2.append(j)
+      pointmatches_list.add(pointmatches)
     syncPrint("Finsihed loading all pointmatches.")
+    tileLinker.connectAll(array(tiles, Tile), array(indices1, 'i'), array(indices2, 'i'), pointmatches_list)
     return tiles
   finally:
     #w.destroy()
@@ -288,25 +462,42 @@ def align(filepaths, csvDir, params, paramsTileConfiguration):
 
   # TODO problem: can fail when there are 0 inliers
 
-  # Return model matrices as double[] arrays with 6 values
-  matrices = []
-  for tile in tiles:
+  # Return model matrices as double[] arrays with 6 values,
+  # filled into a preallocated double[len(tiles)][6]
+  matrices = nativeArray('d', [len(tiles), 6])
+  a = zeros(6, 'd') # reused for every tile
+  for i, tile in enumerate(tiles):
     # BUG in TransformationModel2D.toMatrix
     #a = nativeArray('d', [2, 3])
     #tile.getModel().toMatrix(a)
     #matrices.append(a[0] + a[1])
     # Instead:
-    a = zeros(6, 'd')
-    tile.getModel().toArray(a)
-    matrices.append(array([a[0], a[2], a[4], a[1], a[3], a[5]], 'd'))
+    tile.getModel().toArray(a) # as m00, m10, m01, m11, m02, m12
+    m = matrices[i]
+    m[0], m[1], m[2] = a[0], a[2], a[4]
+    m[3], m[4], m[5] = a[1], a[3], a[5]
 
   saveMatrices(name, matrices, csvDir) # TODO check: saving correctly, now that it's 2D?
   
   return matrices
 
 
+def integerTranslation(matrix, snap=False):
+  """ Return the dx, dy of a 2D affine matrix (6 values, row-packed)
+      when it is a translation by whole pixels, or None otherwise.
+      snap: defaults to False. When True, round a translation to whole pixels. """
+  if 1 != matrix[0] or 0 != matrix[1] or 0 != matrix[3] or 1 != matrix[4]:
+    return None
+  dx, dy = matrix[2], matrix[5]
+  if snap:
+    return int(round(dx)), int(round(dy))
+  if dx == int(dx) and dy == int(dy):
+    return int(dx), int(dy)
+  return None
+
+
 class TranslatedSectionGet(LazyCellImg.Get):
-  def __init__(self, filepaths, loadImg, matrices, img_dimensions, cell_dimensions, interval, copy_threads=1, preload=None):
+  def __init__(self, filepaths, loadImg, matrices, img_dimensions, cell_dimensions, interval, copy_threads=1, preload=None, snap=False):
     self.filepaths = filepaths
     self.loadImg = loadImg # function to load images
     self.matrices = matrices
@@ -317,8 +508,9 @@ class TranslatedSectionGet(LazyCellImg.Get):
     self.cache = SoftMemoize(partial(TranslatedSectionGet.makeCell, self), maxsize=256)
     self.exe = newFixedThreadPool(-1) # BEWARE native memory leak if not closed
     self.preload = preload
+    self.snap = snap # whether to round translations to whole pixels, to copy without interpolation
 
-  def preloadCells(self):
+  def preloadCells(self, index):
     # Submit jobs to concurrently preload cells ahead into the cache, if not there already
     if self.preload is not None and 0 == index % self.preload:
       # e.g. if index=0 and preload=5, will load [1,2,3,4]
@@ -340,19 +532,39 @@ class TranslatedSectionGet(LazyCellImg.Get):
   def get(self, index):
     return self.cache(index) # ENORMOUS Thread contention in accessing every pixel
 
+  def copyTranslated(self, img, aimg, dx, dy):
+    """ Copy into aimg the pixels of img translated by whole pixels dx, dy and cropped to self.interval.
+        Both are wrapped, without copying, as ShortProcessor: its insert method computes
+        the rectangle where both overlap only once, and then copies it row by row
+        with System.arraycopy, all within java. The rest of aimg remains zero.
+        Used when snapping to whole pixels (see makeImg), as when browsing with viewAligned:
+        each cell then costs one copy of the cropped pixels instead of an interpolation per pixel.
+        Pixels falling outside aimg, including for negative offsets, are clipped by insert. """
+    src = ShortProcessor(int(img.dimension(0)), int(img.dimension(1)),
+                         img.update(None).getCurrentStorageArray(), None)
+    dst = ShortProcessor(int(aimg.dimension(0)), int(aimg.dimension(1)),
+                         aimg.update(None).getCurrentStorageArray(), None)
+    # Coordinates in aimg of the first pixel of img
+    dst.insert(src, dx - int(self.interval.min(0)), dy - int(self.interval.min(1)))
+
   def makeCell(self, index):
     img = self.loadImg(self.filepaths[index])
-    affine = AffineTransform2D()
-    affine.set(self.matrices[index])
-    imgI = Views.interpolate(Views.extendZero(img), NLinearInterpolatorFactory())
-    imgA = RealViews.transform(imgI, affine)
-    imgT = Views.zeroMin(Views.interval(imgA, self.interval))
     aimg = img.factory().create(self.interval)
-    ImgUtil.copy(ImgView.wrap(imgT, aimg.factory()),
-                 aimg,
-                 self.copy_threads)
+    translation = integerTranslation(self.matrices[index], snap=self.snap)
+    if translation and isinstance(img, ArrayImg) and isinstance(img.firstElement(), UnsignedShortType):
+      # No interpolation necessary
+      self.copyTranslated(img, aimg, *translation)
+    else:
+      affine = AffineTransform2D()
+      affine.set(self.matrices[index])
+      imgI = Views.interpolate(Views.extendZero(img), NLinearInterpolatorFactory())
+      imgA = RealViews.transform(imgI, affine)
+      imgT = Views.zeroMin(Views.interval(imgA, self.interval))
+      ImgUtil.copy(ImgView.wrap(imgT, aimg.factory()),
+                   aimg,
+                   self.copy_threads)
     #
-    self.preloadCells()
+    self.preloadCells(index)
     #
     return Cell(self.cell_dimensions,
                [0, 0, index],
@@ -396,7 +608,10 @@ class SourcePanning(KeyAdapter):
       syncPrint(str(sys.exc_info()))
 
 
-def makeImg(filepaths, loadImg, img_dimensions, matrices, cropInterval, copy_threads, preload):
+def makeImg(filepaths, loadImg, img_dimensions, matrices, cropInterval, copy_threads, preload, snap=False):
+  """ snap: defaults to False. When True, round each section's translation to whole pixels,
+            so that its pixels are copied directly rather than interpolated. Much faster,
+            at the cost of up to half a pixel of misalignment per section. """
   dims = Intervals.dimensionsAsLongArray(cropInterval)
   voldims = [dims[0],
              dims[1],
@@ -406,7 +621,7 @@ def makeImg(filepaths, loadImg, img_dimensions, matrices, cropInterval, copy_thr
                      1]
   grid = CellGrid(voldims, cell_dimensions)
   cellGet = TranslatedSectionGet(filepaths, loadImg, matrices, img_dimensions, cell_dimensions,
-                                 cropInterval, copy_threads=copy_threads, preload=preload)
+                                 cropInterval, copy_threads=copy_threads, preload=preload, snap=snap)
   return LazyCellImg(grid, pixelType(), cellGet), cellGet
 
 class OnClosing(ImageListener):
@@ -421,9 +636,10 @@ class OnClosing(ImageListener):
   def imageUpdated(self, imp):
     pass
 
-def viewAligned(filepaths, csvDir, params, paramsTileConfiguration, img_dimensions, cropInterval):
+def viewAligned(filepaths, csvDir, params, paramsTileConfiguration, img_dimensions, cropInterval, snap=False):
+  """ snap: see makeImg. """
   matrices = align(filepaths, csvDir, params, paramsTileConfiguration)
-  cellImg, cellGet = makeImg(filepaths, loadUnsignedShort, img_dimensions, matrices, cropInterval, 1, 5)
+  cellImg, cellGet = makeImg(filepaths, loadUnsignedShort, img_dimensions, matrices, cropInterval, 1, 5, snap=snap)
   print cellImg
   comp = showStack(cellImg, title=srcDir.split('/')[-2], proper=False)
   # Add the SourcePanning KeyListener as the first one
@@ -520,8 +736,9 @@ y0 = 3 * dimensions[1] / 8
 x1 = x0 + 2 * dimensions[0] / 8 -1
 y1 = y0 + 2 * dimensions[1] / 8 -1
 print "Crop to: x=%i y=%i width=%i height=%i" % (x0, y0, x1 - x0 + 1, y1 - y0 + 1)
+# For browsing, snap sections to whole pixels: fast, and off by at most half a pixel
 viewAligned(filepaths, csvDir, params, paramsTileConfiguration, dimensions,
-            FinalInterval([x0, y0], [x1, y1]))
+            FinalInterval([x0, y0], [x1, y1]), snap=True)
 
 
 # Write the whole volume in N5 format
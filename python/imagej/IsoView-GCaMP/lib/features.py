@@ -4,7 +4,10 @@ from mpicbg.models import Point, PointMatch
 from net.imglib2 import KDTree, RealPoint
 from net.imglib2.neighborsearch import RadiusNeighborSearchOnKDTree
 from itertools import imap, izip, product
-from jarray import array
+from jarray import array, zeros
+from java.util import ArrayList
+from java.io import RandomAccessFile, FileOutputStream
+from java.nio import ByteBuffer
 import os, sys, csv, types
 from os.path import basename
 # local lib functions:
@@ -226,7 +229,61 @@ def loadFeatures(img_filename, directory, params, validateOnly=False, epsilon=0.
     return None
 
 
+# Identifies a binary pointmatches file, and its version: "PMB1"
+POINTMATCHES_MAGIC = 0x504D4231
+
+def savePointMatchesBinary(path, pointmatches):
+  """ Store the pointmatches in binary form, for fast loading: a header with 3 int values
+      (magic number, number of pointmatches, number of dimensions) followed by,
+      for each PointMatch, the world coordinates of its two points as double values. """
+  pms = list(pointmatches)
+  n_dims = len(pms[0].getP1().getW()) if pms else 0
+  bb = ByteBuffer.allocate(12 + len(pms) * 2 * n_dims * 8)
+  bb.putInt(POINTMATCHES_MAGIC).putInt(len(pms)).putInt(n_dims)
+  db = bb.asDoubleBuffer()
+  for pm in pms:
+    db.put(pm.getP1().getW())
+    db.put(pm.getP2().getW())
+  # Write to a temporary file and then rename it, so that an interrupted write never leaves a partial file
+  tmppath = path + ".tmp"
+  fos = FileOutputStream(tmppath)
+  try:
+    fos.write(bb.array())
+    fos.flush()
+    fos.getFD().sync()
+  finally:
+    fos.close()
+  os.rename(tmppath, path)
+
+
+def loadPointMatchesBinary(path):
+  """ Load the pointmatches stored with savePointMatchesBinary.
+      Returns a list of PointMatch instances, or None if the file is not a binary pointmatches file
+      or its length doesn't match its header (e.g. it was truncated). """
+  ra = RandomAccessFile(path, 'r')
+  try:
+    bytes = zeros(ra.length(), 'b')
+    ra.readFully(bytes)
+  finally:
+    ra.close()
+  bb = ByteBuffer.wrap(bytes)
+  if len(bytes) < 12 or POINTMATCHES_MAGIC != bb.getInt():
+    return None
+  count, n_dims = bb.getInt(), bb.getInt()
+  if count < 0 or n_dims < 0 or len(bytes) != 12 + count * 2 * n_dims * 8:
+    return None
+  coords = zeros(count * 2 * n_dims, 'd')
+  bb.asDoubleBuffer().get(coords)
+  pointmatches = ArrayList(count)
+  for i in xrange(0, len(coords), 2 * n_dims):
+    pointmatches.add(PointMatch(Point(coords[i : i + n_dims]),
+                                Point(coords[i + n_dims : i + 2 * n_dims])))
+  return pointmatches
+
+
 def savePointMatches(img_filename1, img_filename2, pointmatches, directory, params):
+  """ Store the pointmatches in a CSV file, with the params in its first two rows,
+      and also in a binary file (see savePointMatchesBinary) for fast loading. """
   filename = basename(img_filename1) + '.' + basename(img_filename2) + ".pointmatches.csv"
   path = os.path.join(directory, filename)
   try:
@@ -244,6 +301,8 @@ def savePointMatches(img_filename1, img_filename2, pointmatches, directory, para
       # Ensure it's written
       csvfile.flush()
       os.fsync(csvfile.fileno())
+    # Written after the CSV file, so that it is never older than it
+    savePointMatchesBinary(path[:-4] + ".bin", pointmatches)
   except:
     syncPrint("Failed to save pointmatches at %s" % path)
     syncPrint(str(sys.exc_info()))
@@ -253,6 +312,8 @@ def savePointMatches(img_filename1, img_filename2, pointmatches, directory, para
 def loadPointMatches(img1_filename, img2_filename, directory, params, epsilon=0.00001, verbose=True):
   """ Attempts to load point matches from filename1 + '.' + filename2 + ".pointmatches.csv" if it exists,
       returning a list of PointMatch instances or None.
+      The pointmatches are read from the binary file with extension ".pointmatches.bin" when present
+      and not older than the CSV file, whose first two rows are still read to check the params.
       params: dictionary of parameters with which pointmatches are wanted now,
               to compare with parameter with which pointmatches were made.
               In case of mismatch, return None.
@@ -268,8 +329,17 @@ def loadPointMatches(img1_filename, img2_filename, directory, params, epsilon=0.
       # First line contains parameter names, second line their values
       if not checkParams(params, reader.next(), reader.next(), epsilon):
         return None
-      reader.next() # skip header with column names
-      pointmatches = PointMatches.fromRows(reader).pointmatches
+      binpath = csvpath[:-4] + ".bin"
+      pointmatches = None
+      if os.path.exists(binpath) and os.path.getmtime(binpath) >= os.path.getmtime(csvpath):
+        try:
+          pointmatches = loadPointMatchesBinary(binpath)
+        except:
+          syncPrint("Could not read binary pointmatches at %s, reading the CSV file instead" % binpath)
+          syncPrint(str(sys.exc_info()))
+      if pointmatches is None:
+        reader.next() # skip header with column names
+        pointmatches = PointMatches.fromRows(reader).pointmatches
       if verbose:
         syncPrint("Loaded %i pointmatches for %s, %s" % (len(pointmatches), img1_filename, img2_filename))
       return pointmatches
@@ -124,6 +124,10 @@ class KLBLoader(CacheLoader):
   def get(self, path):
     return self.klb.readFull(path)
 
+  def dimensions(self, path):
+    """ Read only the header of the KLB file, returning the dimensions of its 3D image. """
+    return list(self.klb.readHeader(path).imageSize)[:3]
+
 
 class TransformedLoader(CacheLoader):
   def __init__(self, loader, transformsDict, roi=None, asImg=False):
@@ -8,7 +8,7 @@ from net.imglib2.view import Views
 from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
 from net.imglib2.type.numeric.real import FloatType
 from net.imglib2.type.numeric.integer import UnsignedShortType
-from java.util.concurrent import TimeUnit
+from java.util.concurrent import TimeUnit, Semaphore
 import os, re, sys
 from pprint import pprint
 from itertools import izip, chain, repeat
@@ -35,7 +35,8 @@ def deconvolveTimePoints(srcDir,
                          subrange=None,
                          camera_groups=((0, 1), (2, 3)),
                          fine_fwd=False,
-                         n_threads=0): # 0 means all
+                         n_threads=0, # 0 means all
+                         compact_inputs=False):
   """
      Main program entry point.
      For each time point folder TM\d+, find the KLB files of the 4 cameras,
@@ -67,6 +68,8 @@ def deconvolveTimePoints(srcDir,
      fine_fwd: whether the fineTransformsPostROICrop were computed all-to-all, which optimizes the pose and produces direct transforms,
                or, when False, the fineTransformsPostROICrop were computed from 0 to 1, 0 to 2, and 0 to 3, so they are inverted.
      n_threads: number of threads to use. Zero (default) means as many as possible.
+     compact_inputs: whether to store the transformed views in 16-bit instead of 32-bit, halving their memory
+                     footprint and the bytes read per deconvolution iteration. Defaults to False.
   """
   kernel = readFloats(kernel_filepath, [19, 19, 25], header=434)
   klb_loader = KLBLoader()
@@ -79,18 +82,23 @@ def deconvolveTimePoints(srcDir,
 
   # Find all time point folders with pattern TM\d{6} (a TM followed by 6 digits)
   def iterTMs():
-    """ Return a generator over dicts of 4 KLB file paths for each time point. """
+    """ Return a generator over tuples of the 4 KLB file paths for each time point,
+        indexed by camera, with None for any camera whose file is missing.
+        Files of cameras other than 0 to 3 are included at the end of the tuple, to fail validation. """
     for dirname in sorted(os.listdir(srcDir)):
       if not dirname.startswith("TM00"):
         continue
-      filepaths = {}
+      filepaths = [None] * 4
       tm_dir = os.path.join(srcDir, dirname)
       for filename in sorted(os.listdir(tm_dir)):
         r = re.match(pattern, filename)
         if r:
           camera_index = int(r.groups()[0])
-          filepaths[camera_index] = os.path.join(tm_dir, filename)
-      yield filepaths
+          if camera_index < 4:
+            filepaths[camera_index] = os.path.join(tm_dir, filename)
+          else:
+            filepaths.append(os.path.join(tm_dir, filename)) # unexpected camera
+      yield tuple(filepaths)
 
   if subrange:
     indices = set(subrange)
@@ -100,8 +108,10 @@ def deconvolveTimePoints(srcDir,
   
   # Validate folders
   for filepaths in TMs:
-    if 4 != len(filepaths):
-      print "Folder %s has problems: found %i KLB files in it instead of 4." % (tm_dir, len(filepaths))
+    if None in filepaths or len(filepaths) > 4:
+      found = [filepath for filepath in filepaths if filepath]
+      tm_dir = os.path.dirname(found[0]) if found else srcDir
+      print "Folder %s has problems: found %i KLB files in it instead of 4." % (tm_dir, len(found))
       print "Address the issues and rerun."
       return
 
@@ -113,8 +123,8 @@ def deconvolveTimePoints(srcDir,
   # All OK, submit all timepoint folders for registration and deconvolution
 
   # dimensions: all images from each camera have the same dimensions
-  dimensions = [Intervals.dimensionsAsLongArray(klb_loader.get(filepath))
-                for index, filepath in sorted(TMs[0].items(), key=itemgetter(0))]
+  # (read from the KLB headers only, without loading the images)
+  dimensions = [klb_loader.dimensions(filepath) for filepath in TMs[0]]
 
   cmTransforms = cameraTransformations(dimensions[0], dimensions[1], dimensions[2], dimensions[3], calibration)
 
@@ -144,6 +154,8 @@ def deconvolveTimePoints(srcDir,
 
   # A converter from FloatType to UnsignedShortType
   output_converter = createConverter(FloatType, UnsignedShortType)
+  # A converter from UnsignedShortType to FloatType, for compact inputs
+  input_converter = createConverter(UnsignedShortType, FloatType) if compact_inputs else None
 
   target_interval = FinalInterval([0, 0, 0],
                                   [maxC - minC for minC, maxC in izip(roi[0], roi[1])])
@@ -155,11 +167,13 @@ def deconvolveTimePoints(srcDir,
     # Cannot invoke more than one time point at a time because the deconvolution requires a lot of memory.
     for i, filepaths in enumerate(TMs):
       if Thread.currentThread().isInterrupted(): break
-      syncPrint("Deconvolving time point %i with files:\n  %s" %(i, "\n  ".join(sorted(filepaths.itervalues()))))
+      syncPrint("Deconvolving time point %i with files:\n  %s" %(i, "\n  ".join(filepaths)))
       deconvolveTimePoint(filepaths, targetDir, klb_loader,
                           transforms, target_interval,
                           params, PSF_kernels, exe, output_converter,
-                          camera_groups=camera_groups)
+                          camera_groups=camera_groups,
+                          compact_inputs=compact_inputs,
+                          input_converter=input_converter)
   finally:
     exe.shutdown() # Not accepting any more tasks but letting currently executing tasks to complete.
     # Wait until the last task (writing the last file) completes execution.
@@ -170,20 +184,30 @@ def deconvolveTimePoint(filepaths, targetDir, klb_loader,
                         transforms, target_interval,
                         params, PSF_kernels, exe, output_converter,
                         camera_groups=((0, 1), (2, 3)),
-                        write=writeZip):
-  """ filepaths is a dictionary of camera index vs filepath to a KLB file.
+                        write=writeZip,
+                        compact_inputs=False,
+                        input_converter=None):
+  """ filepaths is a tuple of the file paths to the KLB files, indexed by camera.
       With the default camera_groups=((0, 1), (2, 3)) this function will generate
       two deconvolved views, one for each channel,
       where CHN00 is made of CM00 + CM01, and
             CHNO1 is made of CM02 + CM03.
       Will take the camera registrations (cmIsotropicTransforms), which are coarse,
       apply them to the images, then crop the images, then apply the fine transformations.
-      If the deconvolved images exist, it will neither compute it nor write it."""
+      If the deconvolved images exist, it will neither compute it nor write it.
+      With compact_inputs, the transformed views are stored as UnsignedShortType
+      (pixel values come from 16-bit images) and read as FloatType by the deconvolution
+      via an on-the-fly converter. Sub-integer pixel values from the interpolation are rounded.
+      input_converter: the converter from UnsignedShortType to FloatType for compact_inputs,
+                       to create only once for all time points. Created when None."""
   tm_dirname = filepaths[0][filepaths[0].rfind("_TM") + 1:filepaths[0].rfind("_CM")]
 
   n_threads = max(1, Runtime.getRuntime().availableProcessors() -1)
 
-  def prepare(index):
+  if compact_inputs and input_converter is None:
+    input_converter = createConverter(UnsignedShortType, FloatType)
+
+  def prepare(index, copy_threads):
     # Prepare the img for deconvolution:
     # 0. Transform in one step.
     # 1. Ensure its pixel values conform to expectations (no zeros inside)
@@ -192,9 +216,14 @@ def deconvolveTimePoint(filepaths, targetDir, klb_loader,
     img = klb_loader.get(filepaths[index]) # of UnsignedShortType
     imgP = prepareImgForDeconvolution(img, transforms[index], target_interval) # returns of FloatType
     # Copy transformed view into ArrayImg for best performance in deconvolution
-    imgA = ArrayImgs.floats(Intervals.dimensionsAsLongArray(imgP))
-    #ImgUtil.copy(ImgView.wrap(imgP, imgA.factory()), imgA)
-    ImgUtil.copy(imgP, imgA, n_threads / 2) # parallel copying
+    if compact_inputs:
+      imgA = ArrayImgs.unsignedShorts(Intervals.dimensionsAsLongArray(imgP))
+      ImgUtil.copy(convert(imgP, output_converter, UnsignedShortType), imgA, copy_threads) # parallel copying
+      imgA = convert(imgA, input_converter, FloatType)
+    else:
+      imgA = ArrayImgs.floats(Intervals.dimensionsAsLongArray(imgP))
+      #ImgUtil.copy(ImgView.wrap(imgP, imgA.factory()), imgA)
+      ImgUtil.copy(imgP, imgA, copy_threads) # parallel copying
     syncPrint("--Completed preparing %s CM0%i for deconvolution" % (tm_dirname, index))
     imgP = None
     img = None
@@ -208,14 +237,15 @@ def deconvolveTimePoint(filepaths, targetDir, klb_loader,
     return filename, path
 
   # Find out which pairs haven't been created yet
-  futures = []
-  todo = []
-  for indices in camera_groups:
-    filename, path = strings(indices)
-    if not os.path.exists(path):
-      todo.append(indices)
-      for index in indices:
-        futures.append(exe.submit(Task(prepare, index)))
+  todo = [indices for indices in camera_groups
+          if not os.path.exists(strings(indices)[1])]
+
+  # All views are prepared concurrently: share the threads among them
+  n_views = sum(len(indices) for indices in todo)
+  copy_threads = max(1, n_threads / max(1, n_views))
+  futures = [exe.submit(Task(prepare, index, copy_threads))
+             for indices in todo
+             for index in indices]
 
   # Dictionary of index vs imgA
   prepared = dict(f.get() for f in futures)
@@ -223,27 +253,36 @@ def deconvolveTimePoint(filepaths, targetDir, klb_loader,
   def writeToDisk(writeZip, img, path, title=''):
     writeZip(img, path, title=title).flush() # flush the returned ImagePlus
 
-  # Each deconvolution run uses many threads when run with CPU
-  # So do one at a time.
-  last_future = None
-  for indices in todo:
-    if Thread.currentThread().isInterrupted(): break
+  # Each deconvolution run uses many threads when run with CPU, and a lot of memory.
+  # So by default do one at a time, unless params specifies "maxConcurrentDeconvs".
+  # Writing to disk happens outside of the semaphore, overlapping with the next deconvolution.
+  semaphore = Semaphore(params.get("maxConcurrentDeconvs", 1))
+
+  def deconvolveAndSave(indices):
     images = [prepared[index] for index in indices]
-    syncPrint("Invoked deconvolution for %s %s" % (tm_dirname, " ".join("%i" % i for i in indices)))
-    # Deconvolve: merge two views into a single volume
     n_iterations = params["CM_%s_n_iterations" % "_".join("%i" % i for i in indices)]
-    img = multiviewDeconvolution(images, params["blockSizes"], PSF_kernels, n_iterations, exe=exe)
+    semaphore.acquire()
+    try:
+      if Thread.currentThread().isInterrupted(): return
+      syncPrint("Invoked deconvolution for %s %s" % (tm_dirname, " ".join("%i" % i for i in indices)))
+      # Deconvolve: merge two views into a single volume
+      img = multiviewDeconvolution(images, params["blockSizes"], PSF_kernels, n_iterations, exe=exe)
+    finally:
+      semaphore.release()
     # On-the-fly convert to 16-bit: data values are well within the 16-bit range
     imgU = convert(img, output_converter, UnsignedShortType)
     filename, path = strings(indices)
-    # Write in a separate thread so as not to wait
-    last_future = exe.submit(Task(writeToDisk, writeZip, imgU, path, title=filename))
-    imgU = None
-    img = None
-    images = None
+    writeToDisk(writeZip, imgU, path, title=filename)
 
-  if last_future:
-    last_future.get()
+  if todo:
+    # A separate thread pool: the deconvolution itself uses exe
+    exe_decon = newFixedThreadPool(n_threads=len(todo), name="deconvolveAndSave")
+    try:
+      futures = [exe_decon.submit(Task(deconvolveAndSave, indices)) for indices in todo]
+      for f in futures:
+        f.get()
+    finally:
+      exe_decon.shutdown()
 
   prepared = None
 
@@ -339,7 +378,7 @@ def registerDeconvolvedTimePoints(targetDir,
   affines = []
   for matrix in matrices:
     aff = AffineTransform3D()
-    aff.set(*matrix)
+    aff.set(matrix) # a double[]: no unpacking into 12 boxed arguments
     affines.append(aff)
     affines.append(aff) # twice: also for the CM02-CM03
   
@@ -224,9 +224,7 @@ def asBackwardConcatTransforms(matrices, transformclass=AffineTransform3D):
     affines = [aff_previous] # first image at index 0 gets identity
 
     for matrix in matrices[1:]: # skip zero
-      aff = AffineTransform3D()
-      aff.set(*matrix)
-      aff = aff.inverse() # transform defines img1 -> img2, we want the opposite
+      aff = affine3D(matrix).inverse() # transform defines img1 -> img2, we want the opposite
       aff.preConcatenate(aff_previous) # Make relative to prior image
       affines.append(aff) # Store
       aff_previous = aff # next iteration
@@ -322,8 +320,7 @@ def mergeTransforms(calibration, matrices1, roi, matrices2, invert2=False):
     
   transforms = []
   for m1, m2 in izip(matrices1, matrices2):
-    aff = AffineTransform3D()
-    aff.set(*m1)
+    aff = affine3D(m1)
     aff.concatenate(scale3D)
     aff.preConcatenate(roi_translation)
     aff.preConcatenate(affine3D(m2).inverse() if invert2 else affine3D(m2))
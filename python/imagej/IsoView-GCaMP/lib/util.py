@@ -1,6 +1,6 @@
 from __future__ import print_function
 from synchronize import make_synchronized
-from java.util.concurrent import Callable, Future, Executors, ThreadFactory, TimeUnit
+from java.util.concurrent import Callable, Future, Executors, ThreadFactory, TimeUnit, ExecutorCompletionService, ConcurrentHashMap, FutureTask
 from java.util.concurrent.atomic import AtomicInteger
 from java.lang.reflect.Array import newInstance as newArray
 from java.lang import Runtime, Thread, Double, Float, Byte, Short, Integer, Long, Boolean, Character, System
@@ -9,6 +9,8 @@ from net.imglib2.view import Views
 from java.util import LinkedHashMap, Collections, LinkedList, HashMap
 from java.lang.ref import SoftReference
 from java.util.concurrent.locks import ReentrantLock
+from jarray import array as jarray
+from array import array as PyArray
 
 
 printService = Executors.newSingleThreadScheduledExecutor()
@@ -144,6 +146,24 @@ class ParallelTasks:
       if len(self.futures) > chunk_size:
         while len(self.futures) > 0:
           yield self.futures.pop(0).get()
+  def streamConsume(self, max_pending, tasks):
+    """
+    max_pending: maximum number of tasks submitted but not yet consumed.
+    tasks: a generator (or an iterable) with Task instances.
+    Returns a generator with the results, in the order in which tasks complete.
+    Unlike chunkConsume, tasks are submitted continuously, keeping the executor busy.
+    """
+    ecs = ExecutorCompletionService(self.exe)
+    pending = 0
+    for task in tasks:
+      ecs.submit(task)
+      pending += 1
+      if pending >= max_pending:
+        yield ecs.take().get() # waits for the next task to complete
+        pending -= 1
+    while pending > 0:
+      yield ecs.take().get()
+      pending -= 1
   def awaitAll(self):
     while len(self.futures) > 0:
       self.futures.pop(0).get()
@@ -167,8 +187,10 @@ def timeit(n_iterations, fn, *args, **kwargs):
 
 
 def affine3D(matrix):
+  """ matrix: the 12 values of a row-packed 3D affine, as a double[] or a sequence of numbers. """
   aff = AffineTransform3D()
-  aff.set(*matrix)
+  # Pass a double[] as is, avoiding unpacking it into 12 boxed arguments
+  aff.set(matrix if isinstance(matrix, PyArray) and 'd' == matrix.typecode else jarray(matrix, 'd'))
   return aff
 
 
@@ -198,6 +220,7 @@ class SoftMemoize:
     # (I.e. concurrent threads will wait on each other to access the cache)
     self.m = Collections.synchronizedMap(LRUCache(maxsize, eldestFn=lambda ref: ref.clear()))
     self.locks = Collections.synchronizedMap(HashMap())
+    self.pending = ConcurrentHashMap() # key vs Future, for calls via submit in progress
 
   @make_synchronized
   def getOrMakeLock(self, key):
@@ -219,6 +242,27 @@ class SoftMemoize:
       self.locks[key] = lock
     return lock
 
+  def submit(self, key, exe):
+    """ Return a Future with the value for the key, which, if not cached,
+        is computed by calling this SoftMemoize in the ExecutorService exe.
+        Concurrent calls for the same key share the same Future, so that
+        a second call doesn't occupy a thread of exe just to wait on the lock of the key. """
+    softref = self.m.get(key)
+    o = softref.get() if softref else None
+    if o is not None: # an empty list is a valid, cached value
+      return Getter(o)
+    def compute():
+      try:
+        return self(key)
+      finally:
+        self.pending.remove(key)
+    future = FutureTask(Task(compute))
+    existing = self.pending.putIfAbsent(key, future)
+    if existing is not None:
+      return existing
+    exe.execute(future)
+    return future
+
   def __call__(self, key):
     """ Locks on the key, and waits, when needing to execute the memoized function. """
     # Either not present, or garbage collector discarded it
@@ -227,7 +271,7 @@ class SoftMemoize:
       lock.lockInterruptibly()
       softref = self.m.get(key) # self.m is a synchronized map
       o = softref.get() if softref else None
-      if o:
+      if o is not None: # an empty list is a valid, cached value
         return o
       # Invoke the memoized function
       o = self.fn(key)
@@ -1,12 +1,29 @@
-from mpicbg.imagefeatures import FloatArray2DSIFT, FloatArray2D
-from mpicbg.models import PointMatch, TranslationModel2D, NotEnoughDataPointsException
+import os, tempfile
+from collections import defaultdict
+from mpicbg.imagefeatures import FloatArray2DSIFT, FloatArray2D, Feature
+from mpicbg.models import PointMatch, Point, TranslationModel2D, NotEnoughDataPointsException
 from ij import IJ, ImagePlus, ImageStack
 from ij.gui import PointRoi, Roi
 from ij.plugin.frame import RoiManager
+from jarray import zeros
+from java.util.concurrent import Executors, Callable
+from java.lang import Runtime
+from java.util import ArrayList, Random, List
+from fiji.scripting import Weaver
 
-# Open Nile Bend sample image
+# Open Nile Bend sample image, downloading it only once
 # imp = IJ.getImage()
-imp = IJ.openImage("https://imagej.nih.gov/ij/images/NileBend.jpg")
+url = "https://imagej.nih.gov/ij/images/NileBend.jpg"
+cached = os.path.join(tempfile.gettempdir(), "NileBend.tif") # lossless: no JPEG re-encoding
+if os.path.exists(cached):
+  imp = IJ.openImage(cached)
+else:
+  imp = IJ.openImage(url)
+  if imp is None:
+    raise Exception("Could not open " + url)
+  # Save to a temporary file, then rename: an interrupted save is never mistaken for the image
+  IJ.save(imp, cached + ".tmp.tif")
+  os.rename(cached + ".tmp.tif", cached)
 
 # Cut out two overlapping ROIs
 roi1 = Roi(1708, 680, 1792, 1760)
@@ -14,67 +31,306 @@ roi2 = Roi(520, 248, 1660, 1652)
 
 imp.setRoi(roi1)
 imp1 = ImagePlus("cut 1", imp.getProcessor().crop())
-imp1.show()
 
 imp.setRoi(roi2)
 imp2 = ImagePlus("cut 2", imp.getProcessor().crop())
-imp2.show()
+
+# The full image is no longer needed: release its pixels before allocating anything else
+# (unless it is displayed, as when obtained from IJ.getImage())
+if imp.getWindow() is None:
+  imp.flush()
+imp = None
 
 # Parameters for extracting Scale Invariant Feature Transform features
 p = FloatArray2DSIFT.Param()
 p.fdSize = 4 # number of samples per row and column
 p.fdBins = 8 # number of bins per local histogram
-p.maxOctaveSize = 512 # largest scale octave in pixels
-p.minOctaveSize = 128   # smallest scale octave in pixels
+p.maxOctaveSize = 256 # largest scale octave in pixels (of the downscaled image)
+p.minOctaveSize = 64    # smallest scale octave in pixels (of the downscaled image)
 p.steps = 3 # number of steps per scale octave
 p.initialSigma = 1.6
 
-def extractFeatures(ip, params):
+def extractFeatures(ip, params, scale=2):
+  """ SIFT is scale-invariant: extract features from the image downscaled
+      by an integer factor 'scale', which is much cheaper, and then
+      bring the features back to the coordinates of the original image. """
+  if scale > 1:
+    ip = ip.resize(ip.getWidth() / scale, ip.getHeight() / scale, True) # averaging
+  fp = ip.convertToFloat() # a FloatProcessor is returned as is, without a copy
   sift = FloatArray2DSIFT(params)
-  sift.init(FloatArray2D(ip.convertToFloat().getPixels(),
-                         ip.getWidth(), ip.getHeight()))
+  sift.init(FloatArray2D(fp.getPixels(), fp.getWidth(), fp.getHeight()))
   features = sift.run() # instances of mpicbg.imagefeatures.Feature
+  if scale > 1:
+    for f in features:
+      f.location[0] *= scale
+      f.location[1] *= scale
+      f.scale *= scale
   return features
 
-features1 = extractFeatures(imp1.getProcessor(), p)
-features2 = extractFeatures(imp2.getProcessor(), p)
+class ExtractFeatures(Callable):
+  def __init__(self, ip, params):
+    self.ip = ip
+    self.params = params
+  def call(self):
+    return extractFeatures(self.ip, self.params)
+
+# Extract features from both images in parallel
+exe = Executors.newFixedThreadPool(2)
+try:
+  futures = [exe.submit(ExtractFeatures(cut.getProcessor(), p))
+             for cut in [imp1, imp2]]
+  features1, features2 = [f.get() for f in futures]
+finally:
+  exe.shutdown()
+
+def asPointRoi(locations, name):
+  """ Create a PointRoi in one go from a sequence of [x, y] locations,
+      rather than adding each point one at a time. """
+  n = len(locations)
+  xs = zeros(n, 'f')
+  ys = zeros(n, 'f')
+  for i, loc in enumerate(locations):
+    xs[i] = loc[0]
+    ys[i] = loc[1]
+  roi = PointRoi(xs, ys, n)
+  roi.setName(name)
+  return roi
 
 # Feature locations as points in an ROI
 # Store feature locations in the Roi manager for visualization later
 roi_manager = RoiManager()
 
-roi1 = PointRoi()
-roi1.setName("features for cut1")
-for f in features1:
-  roi1.addPoint(f.location[0], f.location[1])
-
+roi1 = asPointRoi([f.location for f in features1], "features for cut1")
 roi_manager.addRoi(roi1)
 
-roi2 = PointRoi()
-roi2.setName("features for cut2")
-for f in features2:
-  roi2.addPoint(f.location[0], f.location[1])
-
+roi2 = asPointRoi([f.location for f in features2], "features for cut2")
 roi_manager.addRoi(roi2)
 
 # Find matches between the two sets of features
 # (only by whether the properties of the features themselves match,
 #  not by their spatial location.)
 rod = 0.9 # ratio of distances in feature similarity space (closest/next closest match)
-pointmatches = FloatArray2DSIFT.createMatches(features1, features2, rod)
+
+# Brute-force nearest neighbor search over descriptors quantized to 8 bits and packed into flat byte arrays,
+# a quarter of the bytes of float descriptors. Compares squared distances (no square roots) in integer
+# arithmetic, summing into 4 independent accumulators.
+# Candidates are abandoned as soon as their partial distance exceeds the second nearest so far.
+matcher = Weaver.method("""
+  /** For each descriptor i in [start, end) of d1, store in matches[i] the index of its nearest
+   *  descriptor in d2 when it passes the ratio test, or -1 otherwise.
+   *  Descriptor values are unsigned bytes. */
+  static public final void match(final byte[] d1, final byte[] d2, final int dim, final float rod,
+                                 final int start, final int end, final int[] matches) {
+    final int n2 = d2.length / dim;
+    final double rod2 = rod * rod; // distances are squared
+    for (int i=start; i<end; ++i) {
+      final int o1 = i * dim;
+      int best = Integer.MAX_VALUE,
+          second = Integer.MAX_VALUE;
+      int bestIndex = -1;
+      for (int j=0, o2=0; j<n2; ++j, o2 += dim) {
+        int d = 0;
+        int k = 0;
+        while (k < dim) {
+          final int kEnd = Math.min(k + 16, dim);
+          int s0 = 0, s1 = 0, s2 = 0, s3 = 0;
+          for (; k < kEnd - 3; k += 4) {
+            final int e0 = (d1[o1 + k    ] & 0xff) - (d2[o2 + k    ] & 0xff),
+                      e1 = (d1[o1 + k + 1] & 0xff) - (d2[o2 + k + 1] & 0xff),
+                      e2 = (d1[o1 + k + 2] & 0xff) - (d2[o2 + k + 2] & 0xff),
+                      e3 = (d1[o1 + k + 3] & 0xff) - (d2[o2 + k + 3] & 0xff);
+            s0 += e0 * e0;
+            s1 += e1 * e1;
+            s2 += e2 * e2;
+            s3 += e3 * e3;
+          }
+          for (; k < kEnd; ++k) {
+            final int e = (d1[o1 + k] & 0xff) - (d2[o2 + k] & 0xff);
+            s0 += e * e;
+          }
+          d += (s0 + s1) + (s2 + s3);
+          // The partial sum only grows: stop when it can no longer be one of the two nearest
+          if (d >= second) break;
+        }
+        if (d < best) {
+          second = best;
+          best = d;
+          bestIndex = j;
+        } else if (d < second) {
+          second = d;
+        }
+      }
+      // As in FloatArray2DSIFT.createMatches, a second nearest neighbor is required
+      matches[i] = -1 != bestIndex && second < Integer.MAX_VALUE && best < rod2 * second ? bestIndex : -1;
+    }
+  }
+
+  /** Quantize the descriptors of all features, each of length dim, to unsigned bytes
+   *  (value * scale, clipped at 255), stored one after another into a single byte[]. */
+  static public final byte[] pack(final List features, final int dim, final float scale) {
+    final byte[] packed = new byte[features.size() * dim];
+    int offset = 0;
+    for (final Object f : features) {
+      final float[] descriptor = ((Feature) f).descriptor;
+      for (int k=0; k<dim; ++k) {
+        packed[offset + k] = (byte) Math.min(255, (int) (descriptor[k] * scale + 0.5f));
+      }
+      offset += dim;
+    }
+    return packed;
+  }
+""", [List, Feature])
+
+def packDescriptors(features, scale=512):
+  """ Quantize the descriptors of all features to 8 bits, into a single contiguous byte[],
+      so that the matcher reads them sequentially. SIFT descriptors are normalized,
+      with values rarely above 0.5: a scale of 512 uses the range of a byte, clipping the rest.
+      Returns the array and the descriptor length. """
+  dim = len(features[0].descriptor) if features else 0
+  return matcher.pack(features, dim, scale), dim
+
+class MatchRows(Callable):
+  def __init__(self, d1, d2, dim, rod, start, end, matches):
+    self.args = (d1, d2, dim, rod, start, end, matches)
+  def call(self):
+    matcher.match(*self.args)
+
+def matchFeatures(features1, features2, rod, n_threads=Runtime.getRuntime().availableProcessors()):
+  """ Like FloatArray2DSIFT.createMatches, including the removal of ambiguous matches
+      (two features of features1 matching features of features2 at the same location,
+      as SIFT emits one feature per dominant orientation at a location),
+      but on 8-bit quantized descriptors and computed in parallel with a compiled inner loop. """
+  if 0 == len(features1) or 0 == len(features2):
+    return ArrayList()
+  d1, dim = packDescriptors(features1)
+  d2, _ = packDescriptors(features2)
+  n1 = len(features1)
+  matches = zeros(n1, 'i')
+  exe = Executors.newFixedThreadPool(n_threads)
+  try:
+    step = max(1, (n1 + n_threads - 1) / n_threads)
+    futures = [exe.submit(MatchRows(d1, d2, dim, rod, start, min(start + step, n1), matches))
+               for start in xrange(0, n1, step)]
+    for f in futures:
+      f.get()
+  finally:
+    exe.shutdown()
+  # Count how many times each location of features2 was matched
+  counts = defaultdict(int)
+  for j in matches:
+    if -1 != j:
+      loc = features2[j].location
+      counts[(loc[0], loc[1])] += 1
+  pointmatches = ArrayList()
+  for i, j in enumerate(matches):
+    if -1 != j:
+      loc = features2[j].location
+      if 1 == counts[(loc[0], loc[1])]:
+        pointmatches.add(PointMatch(Point(features1[i].location), Point(loc)))
+  return pointmatches
+
+pointmatches = matchFeatures(features1, features2, rod)
 
 # Some matches are spatially incoherent: filter matches with RANSAC
+# For a translation, a single point match defines a model: the hypotheses and their
+# residuals reduce to subtractions over flat arrays of coordinate differences.
+ransac = Weaver.method("""
+  /** Returns the number of inliers of the best translation, and flags them in the inliers array.
+   *  dx, dy: the translation of each point match, from its first to its second point.
+   *  iterations: the maximum number of hypotheses to test. Stops earlier once the best hypothesis
+   *  so far has, with probability 'confidence', been drawn from an inlier. */
+  static public final int translation(final double[] dx, final double[] dy, final int iterations,
+                                      final double maxEpsilon, final double confidence, final boolean[] inliers) {
+    final int n = dx.length;
+    if (0 == n) return 0;
+    final double e2 = maxEpsilon * maxEpsilon;
+    // There are only n distinct hypotheses: draw them without repetition, in random order
+    final int[] order = new int[n];
+    for (int i=0; i<n; ++i) order[i] = i;
+    final Random rnd = new Random(69997);
+    for (int i=n-1; i>0; --i) {
+      final int j = rnd.nextInt(i + 1);
+      final int tmp = order[i];
+      order[i] = order[j];
+      order[j] = tmp;
+    }
+    final int maxIterations = Math.min(n, iterations);
+    int end = maxIterations;
+    int bestCount = 0;
+    double tx = 0, ty = 0;
+    for (int t=0; t<end; ++t) {
+      final int k = order[t];
+      final double hx = dx[k], hy = dy[k];
+      int count = 0;
+      for (int i=0; i<n; ++i) {
+        final double ex = dx[i] - hx,
+                     ey = dy[i] - hy;
+        count += ex * ex + ey * ey < e2 ? 1 : 0;
+      }
+      if (count > bestCount) {
+        bestCount = count;
+        tx = hx;
+        ty = hy;
+        // Adaptive termination: with an inlier ratio w and one match per hypothesis,
+        // log(1 - confidence) / log(1 - w) hypotheses suffice to draw an inlier
+        final double w = count / (double) n;
+        end = w >= 1 ? 0 : (int) Math.min(maxIterations, Math.ceil(Math.log(1 - confidence) / Math.log(1 - w)));
+      }
+    }
+    // Refine: fit the translation to the inliers (their mean) until the inlier set is stable
+    int count = -1;
+    for (int r=0; r<10; ++r) {
+      double sx = 0, sy = 0;
+      int c = 0;
+      for (int i=0; i<n; ++i) {
+        final double ex = dx[i] - tx,
+                     ey = dy[i] - ty;
+        inliers[i] = ex * ex + ey * ey < e2;
+        if (inliers[i]) {
+          sx += dx[i];
+          sy += dy[i];
+          ++c;
+        }
+      }
+      if (c == count || 0 == c) break;
+      count = c;
+      tx = sx / c;
+      ty = sy / c;
+    }
+    return Math.max(0, count);
+  }
+""", [Random])
+
+def filterTranslation(candidates, iterations, maxEpsilon, minInlierRatio, minNumInliers, confidence=0.999):
+  """ Like TranslationModel2D.filterRansac but returns the list of inliers,
+      empty when not enough were found. Stops sampling as soon as an inlier
+      hypothesis has been drawn with the given confidence, at most after 'iterations'. """
+  n = len(candidates)
+  dx = zeros(n, 'd')
+  dy = zeros(n, 'd')
+  for i, pm in enumerate(candidates):
+    l1 = pm.getP1().getL()
+    l2 = pm.getP2().getL()
+    dx[i] = l2[0] - l1[0]
+    dy[i] = l2[1] - l1[1]
+  flags = zeros(n, 'z')
+  count = ransac.translation(dx, dy, iterations, maxEpsilon, confidence, flags)
+  if count < minNumInliers or count < minInlierRatio * n:
+    return []
+  return [pm for pm, flag in zip(candidates, flags) if flag]
+
 model = TranslationModel2D() # We know there's only a translation
 candidates = pointmatches # possibly good matches as determined above
-inliers = [] # good point matches, to be filled in by model.filterRansac
 maxEpsilon = 25.0 # max allowed alignment error in pixels (a distance)
 minInlierRatio = 0.05 # ratio inliers/candidates
 minNumInliers = 5 # minimum number of good matches to accept the result
 
+modelFound = False
 try:
-  modelFound = model.filterRansac(candidates, inliers, 1000,
-                                  maxEpsilon, minInlierRatio, minNumInliers)
-  if modelFound:
+  inliers = filterTranslation(candidates, 1000, maxEpsilon, minInlierRatio, minNumInliers)
+  if inliers:
+    model.fit(inliers)
+    modelFound = True
     # Apply the transformation defined by the model to the first point
     # of each pair (PointMatch) of points. That is, to the point from
     # the first image.
@@ -84,17 +340,21 @@ except NotEnoughDataPointsException, e:
 
 if modelFound:
   # Store inlier pointmatches: the spatially coherent subset
-  roi1pm = PointRoi()
+  # In a single pass over the inliers, calling getL() once per point
+  n = len(inliers)
+  xs1, ys1, xs2, ys2 = (zeros(n, 'f') for _ in xrange(4))
+  for i, pm in enumerate(inliers):
+    l1 = pm.getP1().getL()
+    l2 = pm.getP2().getL()
+    xs1[i] = l1[0]
+    ys1[i] = l1[1]
+    xs2[i] = l2[0]
+    ys2[i] = l2[1]
+  roi1pm = PointRoi(xs1, ys1, n)
   roi1pm.setName("matches in cut1")
-  roi2pm = PointRoi()
+  roi2pm = PointRoi(xs2, ys2, n)
   roi2pm.setName("matches in cut2")
 
-  for pm in inliers:
-    p1 = pm.getP1()
-    roi1pm.addPoint(p1.getL()[0], p1.getL()[1])
-    p2 = pm.getP2()
-    roi2pm.addPoint(p2.getL()[0], p2.getL()[1])
-
   roi_manager.addRoi(roi1pm)
   roi_manager.addRoi(roi2pm)
 
@@ -107,14 +367,14 @@ if modelFound:
   canvas_width = int(max(imp1.getWidth(), x1) - min(0, x0))
   canvas_height = int(max(imp1.getHeight(), y1) - min(0, y0))
   # Create a 2-slice stack with both images aligned, one on each slice
+  # (each slice is a new, zero-initialized canvas into which a cut is inserted)
   stack = ImageStack(canvas_width, canvas_height)
+  # Offsets: the cut that lies further to the left (or top) stays at zero
   ip1 = imp1.getProcessor().createProcessor(canvas_width, canvas_height)
-  ip1.insert(imp1.getProcessor(), int(0 if x0 > 0 else abs(x0)),
-                                  int(0 if y0 > 0 else abs(y0)))
+  ip1.insert(imp1.getProcessor(), int(max(0, -x0)), int(max(0, -y0)))
   stack.addSlice("cut1", ip1)
-  ip2 = ip1.createProcessor(canvas_width, canvas_height)
-  ip2.insert(imp2.getProcessor(), int(0 if x0 < 0 else x0),
-                                  int(0 if y0 < 0 else y0))
+  ip2 = imp2.getProcessor().createProcessor(canvas_width, canvas_height)
+  ip2.insert(imp2.getProcessor(), int(max(0, x0)), int(max(0, y0)))
   stack.addSlice("cut2", ip2)
   imp = ImagePlus("registered", stack)
   imp.show()